@@ -1,15 +1,37 @@
 import sys
 import os
-import gc
-from collections import Counter
-from multiprocessing import Pool, cpu_count
+import mmap
+from collections import deque
 from datetime import datetime
 import torch
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
 
 # Global start time
 start_time = datetime.now()
 
+# Odd multiplier used to fold 8-byte lanes of sequences longer than 8 bytes into one int64 key
+LANE_SALT = 0x2545F4914F6CDD1D
+
+# Big-endian byte weights and shifts for packing up to 8 bytes; slice the last L entries for length L
+POWERS_256 = 256 ** np.arange(7, -1, -1, dtype=np.int64)
+BYTE_SHIFTS = 8 * np.arange(7, -1, -1, dtype=np.int64)
+# Past this share of the data, the windows a replacement touches are recounted from scratch instead
+REBUILD_FRACTION = 0.25
+# Most keys the resident count tables keep per length; past that only the most frequent ones stay
+TABLE_ENTRIES = 1 << 15
+
 def get_timestamp():
     """Get the time difference from the start_time."""
     now = datetime.now()
@@ -20,52 +42,116 @@ def get_timestamp():
     minutes, seconds = divmod(remainder, 60)
     return f"[{hours:02}:{minutes:02}:{seconds:02}.{milliseconds:03}]" if hours <= 99 else "[99:59:59.999]+"
 
-def find_missing_sequences_chunk(data, sequence_length, start, end):
-    return {data[i:i + sequence_length] for i in range(start, end - sequence_length + 1)}
+def sequences_from_keys(keys, sequence_length):
+    raw = ((keys[:, None] >> BYTE_SHIFTS[8 - sequence_length:]) & 0xFF).astype(np.uint8).tobytes()
+    return [raw[i:i + sequence_length] for i in range(0, len(raw), sequence_length)]
+
+if njit is not None:
+    @njit(parallel=True, boundscheck=False, cache=True)
+    def mark_present_sequences(values, sequence_length, present):
+        # Every thread only ever stores True, so overlapping writes need no atomics
+        for i in prange(len(values) - sequence_length + 1):
+            key = 0
+            for j in range(sequence_length):
+                key = (key << 8) | values[i + j]
+            present[key] = True
+else:
+    mark_present_sequences = None
 
 def find_missing_sequences(data, sequence_length):
-    data_length = len(data)
-    num_workers = max(int(cpu_count() // 3), 1)
-    chunk_size = (data_length + num_workers - 1) // num_workers
-
-    with Pool(processes=num_workers) as pool:
-        tasks = [(data, sequence_length, i * chunk_size, min((i + 1) * chunk_size, data_length)) for i in range(num_workers)]
-        present_sequence_chunks = pool.starmap(find_missing_sequences_chunk, tasks)
-
-    present_sequences = set().union(*present_sequence_chunks)
-    all_possible_sequences = {bytes((i >> (8 * j)) & 0xFF for j in range(sequence_length)) for i in range(256 ** sequence_length)}
-    return sorted(all_possible_sequences - present_sequences)
+    values = np.frombuffer(data, dtype=np.uint8)
+    if sequence_length == 1:
+        return deque(sequences_from_keys(np.flatnonzero(np.bincount(values, minlength=256) == 0), 1))
+    if sequence_length == 2:
+        # Overlapping byte pairs packed into uint16 are counted in one pass, no bitmap fill needed
+        pairs = (values[:-1].astype(np.uint16) << 8) | values[1:]
+        return deque(sequences_from_keys(np.flatnonzero(np.bincount(pairs, minlength=65536) == 0), 2))
+
+    # Big-endian packing keeps the integer order identical to the sorted order of the byte sequences
+    present = np.zeros(256 ** sequence_length, dtype=np.bool_)
+    if len(values) >= sequence_length and mark_present_sequences is not None:
+        mark_present_sequences(values, sequence_length, present)
+    elif len(values) >= sequence_length:
+        windows = sliding_window_view(values, sequence_length)
+        present[windows.astype(np.int64) @ POWERS_256[8 - sequence_length:]] = True
+    return deque(sequences_from_keys(np.flatnonzero(~present), sequence_length))
 
 def read_file(file_path):
     try:
         with open(file_path, 'rb') as f:
-            return f.read()
-    except IOError as e:
+            if os.fstat(f.fileno()).st_size == 0:
+                return bytearray()
+            # Copy straight out of the page cache into the one buffer that gets compacted in place
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return bytearray(mm)
+    except (IOError, ValueError) as e:
         print(f"{get_timestamp()}Error reading file {file_path}: {e}")
         sys.exit(1)
 
-def write_boo_file(boo_file_path, dictionaries, data, original_extension):
+def pwrite_all(fd, buffers, offset):
+    """Write buffers back to back at offset, one pwritev call unless the kernel writes short."""
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    if not hasattr(os, 'pwritev'):
+        # Windows has no positional writes, so seek once and write the buffers in turn
+        os.lseek(fd, offset, os.SEEK_SET)
+        for view in views:
+            while view:
+                view = view[os.write(fd, view):]
+        return
+    while views:
+        written = os.pwritev(fd, views, offset)
+        offset += written
+        while views and written >= len(views[0]):
+            written -= len(views.pop(0))
+        if written:
+            views[0] = views[0][written:]
+
+def pack_boo_entries(missing_seqs, substituted_seqs):
+    entries = bytearray()
+    for missing_seq, substituted_seq in zip(missing_seqs, substituted_seqs):
+        entries.append(len(missing_seq))
+        entries.append(len(substituted_seq))
+        entries += missing_seq
+        entries += substituted_seq
+    return entries
+
+def create_boo_file(boo_file_path, missing_seqs, substituted_seqs, original_extension, data):
+    """Write a complete boo file beside the target and move it into place, so an existing one is never lost.
+
+    Returns the open descriptor and where the dictionary ends.
+    """
+    temp_path = boo_file_path + '.tmp'
+    # Without O_BINARY, Windows would translate newlines in everything written through the descriptor
+    flags = os.O_RDWR | getattr(os, 'O_BINARY', 0)
     try:
-        with open(boo_file_path, 'wb') as boo_file:
-            boo_file.write(bytes([len(original_extension)]))
-            boo_file.write(original_extension.encode())
-
-            for dictionary in dictionaries:
-                for missing_seq, substituted_seq in dictionary.items():
-                    boo_file.write(bytes([len(missing_seq)]))
-                    boo_file.write(bytes([len(substituted_seq)]))
-                    boo_file.write(missing_seq)
-                    boo_file.write(substituted_seq)
-            boo_file.write(bytes([0, 255]))
-            boo_file.write(data)
-
-        return os.path.getsize(boo_file_path)
-    except IOError as e:
+        boo_fd = os.open(temp_path, flags | os.O_CREAT | os.O_TRUNC, 0o644)
+        header = bytes([len(original_extension)]) + original_extension.encode()
+        entries = pack_boo_entries(missing_seqs, substituted_seqs)
+        pwrite_all(boo_fd, [header, entries, bytes([0, 255]), data], 0)
+        os.fsync(boo_fd)
+        # Windows can't rename an open file, so the descriptor is reopened once the file is in place
+        os.close(boo_fd)
+        os.replace(temp_path, boo_file_path)
+        return os.open(boo_file_path, flags), len(header) + len(entries)
+    except OSError as e:
         print(f"{get_timestamp()}Error writing to boo file {boo_file_path}: {e}")
         sys.exit(1)
 
+def checkpoint_boo_file(boo_fd, missing_seqs, substituted_seqs, dictionary_end, data):
+    """Append the given new dictionary entries and rewrite the data behind them, leaving the rest of the file alone."""
+    try:
+        entries = pack_boo_entries(missing_seqs, substituted_seqs)
+        pwrite_all(boo_fd, [entries, bytes([0, 255]), data], dictionary_end)
+        dictionary_end += len(entries)
+        os.ftruncate(boo_fd, dictionary_end + 2 + len(data))
+        return dictionary_end
+    except OSError as e:
+        print(f"{get_timestamp()}Error writing to boo file: {e}")
+        sys.exit(1)
+
 def load_dictionaries_and_data(boo_file_path):
-    dictionaries = []
+    missing_seqs = []
+    substituted_seqs = []
     with open(boo_file_path, 'rb') as f:
         extension_length = f.read(1)[0]
         original_extension = f.read(extension_length).decode() if extension_length > 0 else ""
@@ -76,142 +162,452 @@ def load_dictionaries_and_data(boo_file_path):
             missing_len = missing_len_byte[0]
             substituted_len = f.read(1)[0]
             if missing_len == 0 and substituted_len == 255:
-                data = f.read()
+                data = bytearray(os.fstat(f.fileno()).st_size - f.tell())
+                f.readinto(data)
                 break
             missing_seq = f.read(missing_len)
             substituted_seq = f.read(substituted_len)
-            dictionaries.append({missing_seq: substituted_seq})
-    return dictionaries, data, original_extension
+            missing_seqs.append(missing_seq)
+            substituted_seqs.append(substituted_seq)
+    return missing_seqs, substituted_seqs, data, original_extension
 
 def add_or_replace_extension(file_path):
     return os.path.splitext(file_path)[0] + '.boo'
 
-def find_top_n_sequences_cuda(data_tensor, missing_sequence_length, max_length, top_n=128):
-    def count_sequences_cuda(data_tensor, length):
-        num_sequences = (len(data_tensor) // length)
-        sequences = data_tensor[:num_sequences * length].view(num_sequences, length)
-        unique_sequences, counts = torch.unique(sequences, return_counts=True, dim=0)
-        mask = counts > 1
-        filtered_unique_sequences = unique_sequences[mask]
-        filtered_counts = counts[mask]
-
-        if len(filtered_unique_sequences) == 0:
-            return None, []
-
-        scores = filtered_counts * (length - missing_sequence_length)
-        top_indices = torch.topk(scores, min(top_n, len(filtered_unique_sequences))).indices
-        best_sequences = filtered_unique_sequences[top_indices]
-        best_counts = filtered_counts[top_indices].cpu().tolist()
-        best_scores = scores[top_indices].cpu().tolist()
-
-        return best_sequences, list(zip(best_scores, best_counts))
-
-    best_overall_sequences = []
-    best_overall_scores = []
-
-    for length in range(missing_sequence_length + 1, max_length + 1):
-        best_sequences, scores = count_sequences_cuda(data_tensor, length)
-        if best_sequences is not None:
-            for i in range(len(best_sequences)):
-                best_overall_sequences.append(best_sequences[i].cpu().tolist())
-                best_overall_scores.append(scores[i])
-
-    # Sort by scores and return the top N
-    combined = list(zip(best_overall_sequences, best_overall_scores))
-    combined.sort(key=lambda x: x[1][0], reverse=True)  # Sort by score
-    top_combined = combined[:top_n]
-    
-    top_sequences, top_scores = zip(*top_combined) if top_combined else ([], [])
-    
-    return list(top_sequences), list(top_scores)
+def to_device(array, device):
+    """Copy a host array to the device, staging it in pinned memory so the copy runs asynchronously."""
+    tensor = torch.from_numpy(array)
+    if torch.device(device).type != 'cuda':
+        return tensor.to(device)
+    # Pinned blocks come from PyTorch's caching host allocator, which reuses them across calls
+    return tensor.pin_memory().to(device, non_blocking=True)
+
+def count_bytes(data):
+    return np.bincount(np.frombuffer(data, dtype=np.uint8), minlength=256)
+
+def find_occurrences(data, sequence):
+    positions = []
+    position = data.find(sequence)
+    while position != -1:
+        positions.append(position)
+        position = data.find(sequence, position + len(sequence))
+    return positions
+
+def is_invertible(data, positions, sequence, missing_sequence, byte_counts):
+    """Check that replacing sequence with missing_sequence at positions can be undone by a plain replace."""
+    # If none of its bytes occur in data, missing_sequence can only show up where it gets inserted
+    if not any(byte_counts[byte] for byte in missing_sequence):
+        return True
+    if data.find(missing_sequence) != -1:
+        return False
+    # A new occurrence has to overlap an inserted copy, and only one starting right before a copy
+    # (but after the previous copy) would be picked up ahead of it when replacing back
+    overlap = len(missing_sequence) - 1
+    previous_end = 0
+    for position in positions:
+        context = data[max(position - overlap, previous_end):position]
+        if (context + missing_sequence[:-1]).find(missing_sequence) != -1:
+            return False
+        previous_end = position + len(sequence)
+    return True
+
+if njit is not None:
+    @njit(boundscheck=False, cache=True)
+    def compact_replacements(values, positions, sequence_length, replacement):
+        # Writes never overtake reads because the replacement is not longer than the sequence
+        write = positions[0]
+        for i in range(len(positions)):
+            for j in range(len(replacement)):
+                values[write + j] = replacement[j]
+            write += len(replacement)
+            read = positions[i] + sequence_length
+            end = positions[i + 1] if i + 1 < len(positions) else len(values)
+            for j in range(end - read):
+                values[write + j] = values[read + j]
+            write += end - read
+        return write
+else:
+    compact_replacements = None
+
+def replace_inplace(data, positions, sequence, replacement):
+    """Replace sequence at positions with a replacement no longer than it, compacting data in place."""
+    if compact_replacements is not None:
+        values = np.frombuffer(data, dtype=np.uint8)
+        write = compact_replacements(values, np.asarray(positions, dtype=np.int64), len(sequence),
+                                     np.frombuffer(replacement, dtype=np.uint8))
+        del values
+    else:
+        view = memoryview(data)
+        write = positions[0]
+        for i, position in enumerate(positions):
+            view[write:write + len(replacement)] = replacement
+            write += len(replacement)
+            read = position + len(sequence)
+            end = positions[i + 1] if i + 1 < len(positions) else len(data)
+            view[write:write + end - read] = view[read:end]
+            write += end - read
+        view.release()
+    del data[write:]
+
+def update_byte_counts(byte_counts, occurrences, sequence, replacement):
+    for byte in sequence:
+        byte_counts[byte] -= occurrences
+    for byte in replacement:
+        byte_counts[byte] += occurrences
+
+def pack_windows(data_tensor):
+    """Pack the 8 bytes starting at every position into one int64, zero padded past the end."""
+    data_length = len(data_tensor)
+    padded = torch.cat([data_tensor.long(), torch.zeros(7, dtype=torch.int64, device=data_tensor.device)])
+    packed = torch.zeros(data_length, dtype=torch.int64, device=data_tensor.device)
+    for j in range(8):
+        packed = (packed << 8) | padded[j:j + data_length]
+    return packed
+
+def window_keys_at(packed, starts, length):
+    """Keys of the windows of one length at starts, gathered from pack_windows lanes like window_keys_kernel."""
+    full_lanes, remainder = divmod(length, 8)
+    keys = torch.zeros(len(starts), dtype=torch.int64, device=packed.device)
+    for lane in range(full_lanes):
+        keys = (keys * LANE_SALT) ^ packed[starts + 8 * lane]
+    if remainder > 0:
+        partial = packed[starts + 8 * full_lanes]
+        keys = (keys * LANE_SALT) ^ ((partial >> (8 * (8 - remainder))) & ((1 << (8 * remainder)) - 1))
+    return keys
+
+if triton is not None:
+    @triton.jit
+    def window_keys_kernel(packed_ptr, keys_ptr, num_windows, full_lanes, remainder, shift, lane_mask, salt, BLOCK_SIZE: tl.constexpr):
+        offsets = tl.program_id(0) * BLOCK_SIZE + tl.arange(0, BLOCK_SIZE)
+        mask = offsets < num_windows
+        keys = tl.zeros([BLOCK_SIZE], dtype=tl.int64)
+        for lane in range(full_lanes):
+            keys = (keys * salt) ^ tl.load(packed_ptr + offsets + 8 * lane, mask=mask, other=0)
+        if remainder > 0:
+            partial = tl.load(packed_ptr + offsets + 8 * full_lanes, mask=mask, other=0)
+            keys = (keys * salt) ^ ((partial >> shift) & lane_mask)
+        tl.store(keys_ptr + offsets, keys, mask=mask)
+
+def window_keys_triton(packed, length, block_size=1024):
+    """Keys of every window of one length in a single kernel, without the lane and prefix temporaries."""
+    num_windows = len(packed) - length + 1
+    full_lanes, remainder = divmod(length, 8)
+    keys = torch.empty(num_windows, dtype=torch.int64, device=packed.device)
+    grid = (triton.cdiv(num_windows, block_size),)
+    window_keys_kernel[grid](packed, keys, num_windows, full_lanes, remainder, 8 * (8 - remainder),
+                             (1 << (8 * remainder)) - 1, LANE_SALT, BLOCK_SIZE=block_size)
+    return keys
+
+def keep_most_frequent(keys, counts, starts):
+    """Trim one length's table to its TABLE_ENTRIES most frequent keys, still sorted by key."""
+    if len(keys) <= TABLE_ENTRIES:
+        return keys, counts, starts
+    kept = torch.topk(counts, TABLE_ENTRIES).indices.sort().values
+    return keys[kept], counts[kept], starts[kept]
+
+def count_sequences_cuda(data_tensor, min_length, max_length):
+    """Count the overlapping windows of each length that occur more than once.
+
+    Returns {length: (keys, counts, starts)} with keys sorted and starts holding one occurrence of each key.
+    """
+    data_length = len(data_tensor)
+    positions = torch.arange(data_length, device=data_tensor.device)
+    packed = pack_windows(data_tensor)
+    use_triton = triton is not None and data_tensor.is_cuda
+    prefix = None
+    tables = {}
+
+    for length in range(1, min(max_length, data_length) + 1):
+        # Keys are exact for up to 8 bytes; longer windows fold their full 8-byte lanes into the prefix
+        num_windows = data_length - length + 1
+        full_lanes, remainder = divmod(length, 8)
+        if remainder == 0 and not use_triton:
+            lane = packed[8 * (full_lanes - 1):8 * (full_lanes - 1) + num_windows]
+            prefix = lane if prefix is None else (prefix[:num_windows] * LANE_SALT) ^ lane
+        if length < min_length:
+            continue
 
-def calculate_boo_size(dictionaries, data, original_extension):
-    boo_size = 1 + len(original_extension)  # For extension length and extension bytes
-    for dictionary in dictionaries:
-        for missing_seq, substituted_seq in dictionary.items():
-            boo_size += 2 + len(missing_seq) + len(substituted_seq)  # For sequence lengths and sequences
-    boo_size += 2  # For termination bytes
-    boo_size += len(data)  # For data
-    return boo_size
+        if use_triton:
+            hashes = window_keys_triton(packed, length)
+        elif remainder == 0:
+            hashes = prefix
+        else:
+            lane = packed[8 * full_lanes:8 * full_lanes + num_windows]
+            hashes = (lane >> (8 * (8 - remainder))) & ((1 << (8 * remainder)) - 1)
+            if prefix is not None:
+                hashes = (prefix[:num_windows] * LANE_SALT) ^ hashes
+
+        unique_hashes, inverse, counts = torch.unique(hashes, return_inverse=True, return_counts=True)
+        first_positions = torch.full((len(unique_hashes),), num_windows, dtype=torch.int64, device=data_tensor.device)
+        first_positions.scatter_reduce_(0, inverse, positions[:num_windows], reduce='amin')
+        mask = counts > 1
+        tables[length] = keep_most_frequent(unique_hashes[mask], counts[mask], first_positions[mask])
+        if not mask.any():
+            # A window never repeats more often than its prefix, so no longer length repeats either
+            for longer in range(length + 1, min(max_length, data_length) + 1):
+                tables[longer] = tuple(torch.empty(0, dtype=torch.int64, device=data_tensor.device) for _ in range(3))
+            break
+
+    return tables
+
+def find_top_n_sequences_cuda(tables, data, missing_sequence_length, top_n=128):
+    lengths = [length for length in sorted(tables) if length > missing_sequence_length and len(tables[length][1])]
+    if not lengths:
+        return [], []
+    device = tables[lengths[0]][1].device
+    max_counts = torch.stack([tables[length][1].max() for length in lengths]).cpu().tolist()
+
+    # Each length reaches its best score exactly, so one that can't beat the top_n-th best of those is out.
+    # Counts can only drop as windows grow, so nothing past the first length without repeats counts either
+    best_scores = [count * (length - missing_sequence_length) for length, count in zip(lengths, max_counts)]
+    threshold = sorted(best_scores, reverse=True)[top_n - 1] if len(best_scores) >= top_n else 0
+    selected = []
+    for length, max_count, best_score in zip(lengths, max_counts, best_scores):
+        if max_count < 2:
+            break
+        if best_score >= threshold:
+            selected.append(length)
+    if not selected:
+        return [], []
+
+    # Queue every length's candidates on the device and bring the winners back in one transfer
+    candidates = []
+    for length in selected:
+        keys, counts, starts = tables[length]
+        scores = torch.where(counts > 1, counts, torch.zeros_like(counts)) * (length - missing_sequence_length)
+        top_indices = torch.topk(scores, min(top_n, len(scores))).indices
+        candidates.append(torch.stack([scores[top_indices], keys[top_indices], starts[top_indices],
+                                       counts[top_indices], torch.full_like(top_indices, length)]))
+    candidates = torch.cat(candidates, dim=1)
+    order = torch.sort(candidates[0], descending=True, stable=True).indices[:top_n]
+    candidates = candidates[:, order].cpu().tolist()
+
+    top_sequences, top_scores = [], []
+    for score, key, start, count, length in zip(*candidates):
+        if count < 2:
+            break
+        if length <= 8:
+            sequence = (key & 0xFFFFFFFFFFFFFFFF).to_bytes(8, 'big')[8 - length:]
+        elif start >= 0:
+            sequence = bytes(data[start:start + length])
+        else:
+            # Hashed keys can't be turned back into bytes, so recount a length whose occurrence was replaced away
+            data_tensor = to_device(np.frombuffer(data, dtype=np.uint8), device)
+            tables.update(count_sequences_cuda(data_tensor, length, length))
+            return find_top_n_sequences_cuda(tables, data, missing_sequence_length, top_n)
+        top_sequences.append(sequence)
+        top_scores.append((score, count))
+
+    return top_sequences, top_scores
+
+def touches_most_windows(positions, span_length, tables, data_length):
+    """Whether the windows overlapping the spans are enough of the data that recounting it is cheaper."""
+    longest = max(tables, default=0)
+    return len(positions) * (span_length + longest - 1) > REBUILD_FRACTION * data_length
+
+def collect_windows(data, span_starts, span_length, tables):
+    """Keys and starts of the windows of every counted length that overlap one of the spans.
+
+    span_starts must be sorted and the spans must not overlap, as find_occurrences returns them.
+    """
+    if not tables:
+        return {}
+    device = next(iter(tables.values()))[0].device
+    longest = max(tables)
+
+    # Only the bytes a touched window can reach cross over, as one buffer of merged segments
+    span_starts = np.asarray(span_starts, dtype=np.int64)
+    segment_lows = np.maximum(span_starts - longest + 1, 0)
+    segment_highs = np.minimum(span_starts + span_length + longest - 1, len(data))
+    first = np.concatenate(([True], segment_lows[1:] > segment_highs[:-1]))
+    segment_lows, segment_highs = segment_lows[first], segment_highs[np.append(first[1:], True)]
+    segment_sizes = segment_highs - segment_lows
+    with memoryview(data) as view:
+        segments = bytearray().join(view[low:high] for low, high in zip(segment_lows.tolist(), segment_highs.tolist()))
+    packed = pack_windows(to_device(np.frombuffer(segments, dtype=np.uint8), device))
+    segment_lows_tensor = to_device(segment_lows, device)
+    segment_shifts = to_device(np.cumsum(segment_sizes) - segment_sizes - segment_lows, device)
+
+    span_starts = to_device(span_starts, device)
+    windows = {}
+    for length in tables:
+        # Each span touches the starts in [start - length + 1, start + span_length); clipping every
+        # range at the end of the previous one leaves them disjoint and in order, so no start repeats
+        high = (span_starts + span_length).clamp(max=max(len(data) - length + 1, 0))
+        low = (span_starts - length + 1).clamp(min=0)
+        low[1:] = torch.maximum(low[1:], high[:-1])
+        sizes = (high - low).clamp(min=0)
+        offsets = torch.cumsum(sizes, 0) - sizes
+        total = int(sizes.sum())
+        starts = torch.arange(total, dtype=torch.int64, device=device) + torch.repeat_interleave(low - offsets, sizes, output_size=total)
+        segment = torch.searchsorted(segment_lows_tensor, starts, right=True) - 1
+        windows[length] = (window_keys_at(packed, starts + segment_shifts[segment], length), starts)
+    return windows
+
+def update_sequence_tables(tables, removed_windows, added_windows, positions, sequence_length, shrink):
+    """Apply one replacement to the counts instead of recounting the whole data.
+
+    removed_windows come from collect_windows on the data before the replacement and added_windows
+    after it; positions are where the replaced sequence started. Keys seen only once among the added
+    windows are left out, so counts of sequences that were unique before can lag behind.
+    """
+    for length, (keys, counts, starts) in tables.items():
+        device = keys.device
+        matches = torch.tensor(positions, dtype=torch.int64, device=device)
+
+        # Shift occurrences left by what the replacements before them removed; drop the replaced ones
+        last_match = torch.searchsorted(matches, starts + length) - 1
+        overlapped = (last_match >= 0) & (matches[last_match.clamp(min=0)] + sequence_length > starts)
+        shifted = starts - shrink * torch.searchsorted(matches, starts)
+        starts = torch.where((starts >= 0) & ~overlapped, shifted, torch.full_like(starts, -1))
+
+        removed_keys, _ = removed_windows[length]
+        if len(keys) and len(removed_keys):
+            index = torch.searchsorted(keys, removed_keys).clamp(max=len(keys) - 1)
+            found = keys[index] == removed_keys
+            counts.index_add_(0, index[found], torch.full_like(index[found], -1))
+
+        added_keys, added_starts = added_windows[length]
+        found = torch.zeros(len(added_keys), dtype=torch.bool, device=device)
+        if len(keys) and len(added_keys):
+            index = torch.searchsorted(keys, added_keys).clamp(max=len(keys) - 1)
+            found = keys[index] == added_keys
+            counts.index_add_(0, index[found], torch.ones_like(index[found]))
+            current_starts = starts[index[found]]
+            starts[index[found]] = torch.where(current_starts >= 0, current_starts, added_starts[found])
+
+        # Merge the new keys that repeat into the sorted table without re-sorting it
+        new_keys, inverse, new_counts = torch.unique(added_keys[~found], return_inverse=True, return_counts=True)
+        new_starts = torch.full((len(new_keys),), -1, dtype=torch.int64, device=device)
+        new_starts.scatter_reduce_(0, inverse, added_starts[~found], reduce='amax')
+        repeated = new_counts > 1
+        new_keys, new_counts, new_starts = new_keys[repeated], new_counts[repeated], new_starts[repeated]
+        if len(new_keys):
+            merged_size = len(keys) + len(new_keys)
+            old_slots = torch.searchsorted(new_keys, keys) + torch.arange(len(keys), device=device)
+            new_slots = torch.searchsorted(keys, new_keys) + torch.arange(len(new_keys), device=device)
+            merged = []
+            for old, new in ((keys, new_keys), (counts, new_counts), (starts, new_starts)):
+                values = torch.empty(merged_size, dtype=torch.int64, device=device)
+                values[old_slots] = old
+                values[new_slots] = new
+                merged.append(values)
+            keys, counts, starts = merged
+
+        tables[length] = keep_most_frequent(keys, counts, starts)
 
 def main(file_path, total_iterations, max_length, top_n=256):
     boo_file_path = add_or_replace_extension(file_path)
 
     if file_path.endswith('.boo'):
         boo_file_path = file_path
-        dictionaries, data, original_extension = load_dictionaries_and_data(file_path)
-        iteration_count = len(dictionaries)
+        missing_seqs, substituted_seqs, data, original_extension = load_dictionaries_and_data(file_path)
+        iteration_count = len(missing_seqs)
     else:
         data = read_file(file_path)
-        dictionaries = []
+        missing_seqs = []
+        substituted_seqs = []
         original_extension = os.path.splitext(file_path)[1]
         iteration_count = 0
 
     original_size = os.path.getsize(file_path)
+    byte_counts = count_bytes(data)
+    # The file starts out complete, and every 100 new entries are appended behind the ones on disk along with the data
+    boo_fd, dictionary_end = create_boo_file(boo_file_path, missing_seqs, substituted_seqs, original_extension, data)
+    written_count = len(missing_seqs)
+    in_pass = False
+    dictionary_size = dictionary_end + 2  # Header, entries and termination bytes
+    try:
+        data_tensor = to_device(np.frombuffer(data, dtype=np.uint8), 'cuda')
+        tables = count_sequences_cuda(data_tensor, 2, max_length)
+        del data_tensor
 
-    sequence_length = 1
+        sequence_length = 1
 
-    while sequence_length <= max_length and (total_iterations == -1 or iteration_count < total_iterations):
+        while sequence_length <= max_length and (total_iterations == -1 or iteration_count < total_iterations):
 
-        print(f"{get_timestamp()} Processing sequence length: {sequence_length}", end='...'),
-        missing_sequences = find_missing_sequences(data, sequence_length)
-        if not missing_sequences:
-            sequence_length += 1
-            print()
-            continue
-        else:
-            print(f" Found {len(missing_sequences)} sequences")
+            print(f"{get_timestamp()} Processing sequence length: {sequence_length}", end='...'),
+            missing_sequences = find_missing_sequences(data, sequence_length)
+            if not missing_sequences:
+                sequence_length += 1
+                print()
+                continue
+            else:
+                print(f" Found {len(missing_sequences)} sequences")
 
-        while missing_sequences and (total_iterations == -1 or iteration_count < total_iterations):
+            while missing_sequences and (total_iterations == -1 or iteration_count < total_iterations):
             
-            data_tensor = torch.tensor(np.frombuffer(data, dtype=np.uint8), device='cuda', dtype=torch.uint8)
-            top_sequences, scores = find_top_n_sequences_cuda(data_tensor, sequence_length, max_length, top_n)
-            if not top_sequences:
-                break
+                top_sequences, scores = find_top_n_sequences_cuda(tables, data, sequence_length, top_n)
+                if not top_sequences:
+                    break
             
-            used_bytes = set()
-            found_valid_replacement = False
-            for highest_score_sequence in top_sequences:
-                highest_score_sequence = bytearray(highest_score_sequence)
+                used_bytes = set()
+                found_valid_replacement = False
+                for highest_score_sequence in top_sequences:
+                    highest_score_sequence = bytes(highest_score_sequence)
                 
-                if any(byte in used_bytes for byte in highest_score_sequence):
-                    break
+                    if any(byte in used_bytes for byte in highest_score_sequence):
+                        break
+
+                    positions = find_occurrences(data, highest_score_sequence)
+                    if not positions:
+                        continue
                 
-                while missing_sequences:
-                    first_missing_sequence = missing_sequences.pop(0)
-                    data1 = data
-                    data = data.replace(bytes(highest_score_sequence), bytes(first_missing_sequence))
-                    data2 = data.replace(bytes(first_missing_sequence), bytes(highest_score_sequence))
-                    
-                    if data1 == data2:
+                    first_missing_sequence = None
+                    while missing_sequences:
+                        candidate_sequence = missing_sequences.popleft()
+                        if is_invertible(data, positions, highest_score_sequence, candidate_sequence, byte_counts):
+                            first_missing_sequence = candidate_sequence
+                            break
+
+                        print(f"{get_timestamp()} Replacement failed for {candidate_sequence} with {highest_score_sequence}")
+
+                    if first_missing_sequence is not None:
+                        # The data is rewritten in place, so it only matches the entries again once this one is added
+                        in_pass = True
+                        shrink = len(highest_score_sequence) - len(first_missing_sequence)
+                        if touches_most_windows(positions, len(highest_score_sequence), tables, len(data)):
+                            replace_inplace(data, positions, highest_score_sequence, first_missing_sequence)
+                            data_tensor = to_device(np.frombuffer(data, dtype=np.uint8), 'cuda')
+                            tables = count_sequences_cuda(data_tensor, 2, max_length)
+                            del data_tensor
+                        else:
+                            removed_windows = collect_windows(data, positions, len(highest_score_sequence), tables)
+                            replace_inplace(data, positions, highest_score_sequence, first_missing_sequence)
+                            inserted_positions = [position - i * shrink for i, position in enumerate(positions)]
+                            added_windows = collect_windows(data, inserted_positions, len(first_missing_sequence), tables)
+                            update_sequence_tables(tables, removed_windows, added_windows, positions, len(highest_score_sequence), shrink)
+                        update_byte_counts(byte_counts, len(positions), highest_score_sequence, first_missing_sequence)
                         used_bytes.update(highest_score_sequence)
                         found_valid_replacement = True
-                        break
-
-                    else:
-                        print(f"{get_timestamp()} Replacement failed for {bytes(first_missing_sequence)} with {bytes(highest_score_sequence)}")
-                        data = data1
+                        missing_seqs.append(first_missing_sequence)
+                        substituted_seqs.append(highest_score_sequence)
+                        iteration_count += 1
+                        in_pass = False
 
-                if found_valid_replacement:
-                    dictionaries.append({first_missing_sequence: highest_score_sequence})
-                    iteration_count += 1
+                        dictionary_size += 2 + len(first_missing_sequence) + len(highest_score_sequence)
 
-                    if iteration_count % 100 == 0:
-                        new_size =  write_boo_file(boo_file_path, dictionaries, data, original_extension)
+                        if len(missing_seqs) - written_count >= 100:
+                            dictionary_end = checkpoint_boo_file(boo_fd, missing_seqs[written_count:], substituted_seqs[written_count:], dictionary_end, data)
+                            written_count = len(missing_seqs)
 
-                    new_size = calculate_boo_size(dictionaries, data, original_extension)
-                    ratio = f"{(new_size / original_size) * 100:.3f}%"
+                        new_size = dictionary_size + len(data)
+                        ratio = f"{(new_size / original_size) * 100:.3f}%"
 
-                    print(f"{get_timestamp()} Iteration {iteration_count} for sequence length {sequence_length} completed. Size {new_size}b Ratio {ratio} Substituted sequence length {len(highest_score_sequence)}")
+                        print(f"{get_timestamp()} Iteration {iteration_count} for sequence length {sequence_length} completed. Size {new_size}b Ratio {ratio} Substituted sequence length {len(highest_score_sequence)}")
                     
 
-            if not found_valid_replacement:
-                print(f"{get_timestamp()} No valid replacements found for sequence length {sequence_length}. Moving to the next length.")
-                break
+                if not found_valid_replacement:
+                    print(f"{get_timestamp()} No valid replacements found for sequence length {sequence_length}. Moving to the next length.")
+                    break
             
-        sequence_length += 1
-    
-    new_size = write_boo_file(boo_file_path, dictionaries, data, original_extension)
+            sequence_length += 1
+    finally:
+        # Entries not checkpointed yet are written on the way out, unless a replacement was cut short while
+        # rewriting the data in place, in which case the file keeps the last checkpoint
+        if written_count < len(missing_seqs) and not in_pass:
+            checkpoint_boo_file(boo_fd, missing_seqs[written_count:], substituted_seqs[written_count:], dictionary_end, data)
+        os.close(boo_fd)
 
 if __name__ == "__main__":
     if len(sys.argv) < 4:
@@ -1,16 +1,45 @@
 import sys
 import os
-import gc
+import mmap
+import heapq
 from collections import Counter
 from multiprocessing import Pool, cpu_count
-from datetime import datetime
-
-def time_difference(start_time, end_time):
-    diff = abs(end_time - start_time)
-    total_seconds = int(diff.total_seconds())
-    milliseconds = int((diff.total_seconds() - total_seconds) * 1000)
-    hours, remainder = divmod(total_seconds, 3600)
-    minutes, seconds = divmod(remainder, 60)
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter_ns
+from operator import itemgetter
+from struct import iter_unpack
+from array import array
+
+try:
+    from pydivsufsort import divsufsort, kasai
+except ImportError:
+    divsufsort = None
+
+try:
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    np = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+NUM_WORKERS = max(int(cpu_count() // 1.5), 1)
+# Past this share of the data, the windows a pass touches are recounted from scratch instead of patched
+REBUILD_FRACTION = 0.25
+# Odd multiplier folding the 8-byte lanes of longer windows into one id on the NumPy path
+LANE_SALT = 0x2545F4914F6CDD1D
+# FNV-1a parameters for hashing windows inside the compiled kernels
+FNV_OFFSET = 0xCBF29CE484222325
+FNV_PRIME = 0x100000001B3
+
+def time_difference(start_ns, end_ns):
+    milliseconds = abs(end_ns - start_ns) // 1_000_000
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
     return f"[{hours:02}:{minutes:02}:{seconds:02}.{milliseconds:03}]" if hours <= 99 else "[99:59:59.999]+"
 
 def merge_counters(counters):
@@ -22,50 +51,404 @@ def merge_counters(counters):
 def filter_subsequences(subsequences):
     return {k: v for k, v in subsequences.items() if v > 1}
 
-def extract_and_filter_subsequences(data, min_length=1, max_length=256):
-    data_length = len(data)
-    num_workers = max(int(cpu_count() // 1.5), 1)
-    chunk_size = (data_length + num_workers - 1) // num_workers
+def attach_shared_data(name):
+    global shared_data
+    shared_data = SharedMemory(name=name)
+
+def extract_subsequences_shared(data_length, min_length, max_length, start, end):
+    return extract_subsequences_chunk(shared_data.buf[:data_length], min_length, max_length, start, end)
 
-    with Pool(processes=num_workers) as pool:
-        tasks = [(data, min_length, max_length, i * chunk_size, min((i + 1) * chunk_size, data_length)) for i in range(num_workers)]
-        subsequence_chunks = pool.starmap(extract_subsequences_chunk, tasks)
+def extract_and_filter_subsequences(data, pool, shared, min_length=1, max_length=256):
+    if divsufsort is not None:
+        return repeated_subsequences(data, min_length, max_length)
+    if np is not None:
+        return count_repeated_windows(data, min_length, max_length)
+
+    # Workers read the data from shared memory instead of getting a pickled copy with every task
+    data_length = len(data)
+    shared.buf[:data_length] = data
+    chunk_size = (data_length + NUM_WORKERS - 1) // NUM_WORKERS
+    tasks = [(data_length, min_length, max_length, i * chunk_size, min((i + 1) * chunk_size, data_length)) for i in range(NUM_WORKERS)]
+    subsequence_chunks = pool.starmap(extract_subsequences_shared, tasks)
 
     subsequences = merge_counters(subsequence_chunks)
     return filter_subsequences(subsequences)
 
 def extract_subsequences_chunk(data, min_length, max_length, start, end):
+    """Count the windows starting in [start, end), reading past end for the ones crossing it."""
     subsequences = Counter()
     for length in range(min_length, max_length + 1):
-        for i in range(start, end - length + 1):
-            subseq = data[i:i + length]
-            subsequences[subseq] += 1
+        stop = min(end, len(data) - length + 1)
+        # Windows at the same offset modulo length tile the data, so each offset is one unpack in C
+        for offset in range(start, min(start + length, stop)):
+            windows = (stop - offset + length - 1) // length
+            subsequences.update(map(itemgetter(0), iter_unpack(f'{length}s', data[offset:offset + windows * length])))
     return subsequences
 
-def find_most_common_subsequences(subsequence_counts, missing_sequence_length, top_n=256):
-    scored_subsequences = {k: ((len(k) - missing_sequence_length) * v, v) for k, v in subsequence_counts.items()}
-    return sorted(scored_subsequences.items(), key=lambda item: item[1][0], reverse=True)[:top_n]
-
-def find_missing_sequences_chunk(data, sequence_length, start, end):
-    return {data[i:i + sequence_length] for i in range(start, end - sequence_length + 1)}
+def repeated_subsequences(data, min_length, max_length):
+    """Every substring seen more than once with its count, read off the LCP intervals of a suffix array."""
+    if len(data) < 2:
+        return {}
+    suffix_array = divsufsort(data)
+    lcp = kasai(data, suffix_array).tolist()
+    suffixes = suffix_array.tolist()
+    view = memoryview(data)
+
+    # Each interval of suffixes sharing a prefix of `height` bytes holds one substring per length
+    # between its parent's height and its own, all occurring once per suffix in the interval
+    subsequences = {}
+    stack = [(0, 0)]
+    for i, height in enumerate(lcp):
+        left = i
+        while stack[-1][0] > height:
+            interval_height, left = stack.pop()
+            offset = suffixes[left]
+            count = i - left + 1
+            for length in range(max(height, stack[-1][0], min_length - 1) + 1, min(interval_height, max_length) + 1):
+                subsequences[bytes(view[offset:offset + length])] = count
+        if stack[-1][0] < height:
+            stack.append((height, left))
+    return subsequences
 
-def find_missing_sequences(data, sequence_length):
-    data_length = len(data)
-    num_workers = max(int(cpu_count() // 1.5), 1)
-    chunk_size = (data_length + num_workers - 1) // num_workers
+if njit is not None:
+    @njit(parallel=True, boundscheck=False, cache=True)
+    def window_hashes(values, length):
+        hashes = np.empty(len(values) - length + 1, dtype=np.uint64)
+        for i in prange(len(hashes)):
+            window_hash = np.uint64(FNV_OFFSET)
+            for j in range(length):
+                window_hash = (window_hash ^ np.uint64(values[i + j])) * np.uint64(FNV_PRIME)
+            hashes[i] = window_hash
+        return hashes
+
+    @njit(parallel=True, boundscheck=False, cache=True)
+    def window_keys(values, length):
+        # Up to 8 bytes the key is the window itself read big-endian
+        keys = np.empty(len(values) - length + 1, dtype=np.uint64)
+        for i in prange(len(keys)):
+            key = np.uint64(0)
+            for j in range(length):
+                key = (key << np.uint64(8)) | np.uint64(values[i + j])
+            keys[i] = key
+        return keys
+
+    @njit(parallel=True, boundscheck=False, cache=True)
+    def clashing_groups(values, length, offsets, group_starts, group_ends):
+        clashes = np.zeros(len(group_starts), dtype=np.bool_)
+        for group in prange(len(group_starts)):
+            first = offsets[group_starts[group]]
+            for k in range(group_starts[group] + 1, group_ends[group]):
+                other = offsets[k]
+                for j in range(length):
+                    if values[first + j] != values[other + j]:
+                        clashes[group] = True
+                        break
+                if clashes[group]:
+                    break
+        return clashes
+elif np is not None:
+    def window_hashes(values, length):
+        # Up to 8 bytes the id is the window itself read big-endian
+        windows = sliding_window_view(values, length)
+        hashes = None
+        for lane in range(0, length, 8):
+            lane_bytes = windows[:, lane:lane + 8]
+            lane_ids = lane_bytes.astype(np.uint64) @ (np.uint64(256) ** np.arange(lane_bytes.shape[1] - 1, -1, -1, dtype=np.uint64))
+            hashes = lane_ids if hashes is None else (hashes * np.uint64(LANE_SALT)) ^ lane_ids
+        return hashes
+
+    def clashing_groups(values, length, offsets, group_starts, group_ends):
+        # Compare every later member of a group with its first one, one byte column at a time
+        others = group_ends - group_starts - 1
+        group_of = np.repeat(np.arange(len(group_starts)), others)
+        rank = np.arange(len(group_of)) - np.repeat(np.cumsum(others) - others, others)
+        members = offsets[group_starts[group_of] + 1 + rank]
+        firsts = offsets[group_starts[group_of]]
+        mismatch = np.zeros(len(members), dtype=np.bool_)
+        for j in range(length):
+            mismatch |= values[members + j] != values[firsts + j]
+        clashes = np.zeros(len(group_starts), dtype=np.bool_)
+        clashes[group_of[mismatch]] = True
+        return clashes
+
+def count_repeated_windows(data, min_length, max_length):
+    """Count every window of the whole data at once, keeping those seen more than once."""
+    values = np.frombuffer(data, dtype=np.uint8)
+    view = memoryview(data)
+    subsequences = {}
+    for length in range(min_length, max_length + 1):
+        if len(values) < length:
+            break
+        if length <= 8 and njit is not None:
+            hashes = window_keys(values, length)
+        else:
+            hashes = window_hashes(values, length)
+        offsets = np.argsort(hashes, kind='stable')
+        sorted_hashes = hashes[offsets]
+        bounds = np.concatenate(([0], np.flatnonzero(sorted_hashes[1:] != sorted_hashes[:-1]) + 1, [len(offsets)]))
+        repeated = np.flatnonzero(np.diff(bounds) > 1)
+        group_starts, group_ends = bounds[repeated], bounds[repeated + 1]
+
+        # Windows sharing a hash are compared byte for byte; groups that really clash are counted by their bytes.
+        # Up to 8 bytes the id is the window itself, so no group can clash
+        if length <= 8:
+            clashes = np.zeros(len(group_starts), dtype=np.bool_)
+        else:
+            clashes = clashing_groups(values, length, offsets, group_starts, group_ends)
+        for start, end, clash in zip(group_starts.tolist(), group_ends.tolist(), clashes.tolist()):
+            if clash:
+                counts = Counter(bytes(view[offset:offset + length]) for offset in offsets[start:end].tolist())
+                subsequences.update({k: v for k, v in counts.items() if v > 1})
+            else:
+                offset = int(offsets[start])
+                subsequences[bytes(view[offset:offset + length])] = end - start
+    return subsequences
 
-    with Pool(processes=num_workers) as pool:
-        tasks = [(data, sequence_length, i * chunk_size, min((i + 1) * chunk_size, data_length)) for i in range(num_workers)]
-        present_sequence_chunks = pool.starmap(find_missing_sequences_chunk, tasks)
+def find_most_common_subsequences(subsequence_counts, missing_sequence_length, top_n=256):
+    # A bounded heap keeps only the top_n entries instead of scoring and sorting every one
+    top = heapq.nlargest(top_n, subsequence_counts.items(), key=lambda item: (len(item[0]) - missing_sequence_length) * item[1])
+    return [(k, ((len(k) - missing_sequence_length) * v, v)) for k, v in top]
+
+def replaced_positions(data, sequence, covered):
+    """Starts of the occurrences bytes.replace would substitute, or None as soon as one touches a covered span."""
+    positions = array('q')
+    position = data.find(sequence)
+    while position != -1:
+        if covered.find(1, position, position + len(sequence)) != -1:
+            return None
+        positions.append(position)
+        position = data.find(sequence, position + len(sequence))
+    return positions
+
+def is_invertible(data, positions, sequence, missing_sequence):
+    """Check that replacing sequence at positions with a missing_sequence absent from data can be undone by a plain replace."""
+    # A new occurrence has to overlap an inserted copy, and only one starting right before a copy
+    # (but after the previous copy) would be picked up ahead of it when replacing back
+    overlap = len(missing_sequence) - 1
+    previous_end = 0
+    for position in positions:
+        context = bytes(data[max(position - overlap, previous_end):position])
+        if (context + missing_sequence[:-1]).find(missing_sequence) != -1:
+            return False
+        previous_end = position + len(sequence)
+    return True
+
+def pick_replacement(data, positions, sequence, missing_sequences, inserted_bytes):
+    """Pop the smallest missing sequence that can replace sequence at positions and be swapped back on decompression."""
+    # The list is sorted in descending order, so the smallest sequences are popped from its tail
+    index = len(missing_sequences) - 1
+    while index >= 0:
+        missing_sequence = missing_sequences[index]
+        # The byte test is cheap, so only the sequences that pass it scan the data
+        if not inserted_bytes.intersection(missing_sequence):
+            if data.find(missing_sequence) != -1:
+                # Earlier substitutions put it into the data, so it is no longer missing
+                del missing_sequences[index]
+            elif is_invertible(data, positions, sequence, missing_sequence):
+                return missing_sequences.pop(index)
+        index -= 1
+    return None
+
+def select_substitutions(data, candidates, missing_sequences, limit):
+    """Pick substitutions that can all be applied in one pass with the result of applying them in order.
+
+    Each accepted sequence gets the first missing sequence that can be swapped back. A later candidate is
+    skipped when an occurrence it would replace touches a span an earlier one replaces, or when it holds a
+    byte of an earlier replacement, since only then could replacing in order remove or create occurrences
+    of it that bytes.replace would pick.
+    Replacements sharing no byte with earlier ones can't form across them either, so checking each
+    against the data as it was before the pass is enough.
+    """
+    covered = bytearray(len(data))
+    inserted_bytes = set()
+    substitutions = []
+    for sequence, _ in candidates:
+        if len(substitutions) == limit or not missing_sequences:
+            break
+        if inserted_bytes.intersection(sequence):
+            continue
+        # Positions are only looked up for the candidates the pass gets to, and only the ones replaced are kept
+        replaced = replaced_positions(data, sequence, covered)
+        if not replaced:
+            continue
+        replacement = pick_replacement(data, replaced, sequence, missing_sequences, inserted_bytes)
+        if replacement is None:
+            continue
+        for position in replaced:
+            covered[position:position + len(sequence)] = b'\x01' * len(sequence)
+        inserted_bytes.update(replacement)
+        substitutions.append((sequence, replacement, replaced))
+    return substitutions
+
+def substituted_spans(substitutions):
+    return sorted((position, len(sequence)) for sequence, _, positions in substitutions for position in positions)
+
+def apply_substitutions(data, substitutions):
+    """Apply every substitution to the bytearray in one left to right pass and return the inserted spans.
+
+    Replacements are never longer than what they replace, so the writes never overtake the reads and
+    the data is compacted in place, then truncated once.
+    """
+    spans = sorted((position, sequence, replacement) for sequence, replacement, positions in substitutions for position in positions)
+    view = memoryview(data)
+    added_spans = []
+    write = read = 0
+    for position, sequence, replacement in spans:
+        view[write:write + position - read] = view[read:position]
+        write += position - read
+        view[write:write + len(replacement)] = replacement
+        added_spans.append((write, len(replacement)))
+        write += len(replacement)
+        read = position + len(sequence)
+    view[write:write + len(data) - read] = view[read:]
+    write += len(data) - read
+    view.release()
+    del data[write:]
+    return added_spans
+
+def touches_most_windows(spans, max_length, data_length):
+    """Whether the windows overlapping the spans are enough of the data that recounting it is cheaper."""
+    touched = sum(span_length for _, span_length in spans) + len(spans) * (max_length - 1)
+    return touched > REBUILD_FRACTION * data_length
+
+def touched_ranges(spans, length, data_length):
+    """Disjoint ranges of the starts of the windows of one length that overlap the sorted, disjoint spans."""
+    previous_end = 0
+    for span_start, span_length in spans:
+        low = max(span_start - length + 1, previous_end)
+        previous_end = max(min(span_start + span_length, data_length - length + 1), low)
+        if low < previous_end:
+            yield low, previous_end
+
+def collect_windows(data, spans, min_length, max_length):
+    """Count the windows of every length in range that overlap one of the sorted, disjoint (start, length) spans."""
+    if np is not None:
+        return collect_windows_numpy(data, spans, min_length, max_length)
+    windows = Counter()
+    for length in range(min_length, max_length + 1):
+        for low, high in touched_ranges(spans, length, len(data)):
+            # Windows at the same offset modulo length tile the range, so each offset is one unpack in C
+            for offset in range(low, min(low + length, high)):
+                count = (high - offset + length - 1) // length
+                windows.update(map(itemgetter(0), iter_unpack(f'{length}s', data[offset:offset + count * length])))
+    return windows
+
+def collect_windows_numpy(data, spans, min_length, max_length):
+    values = np.frombuffer(data, dtype=np.uint8)
+    span_starts = np.array([span_start for span_start, _ in spans], dtype=np.int64)
+    span_ends = span_starts + np.array([span_length for _, span_length in spans], dtype=np.int64)
+    windows = Counter()
+    for length in range(min_length, min(max_length, len(values)) + 1):
+        # Clipping each range at the end of the previous one leaves them disjoint, so no start repeats
+        high = np.minimum(span_ends, len(values) - length + 1)
+        low = np.maximum(span_starts - length + 1, 0)
+        low[1:] = np.maximum(low[1:], high[:-1])
+        sizes = np.maximum(high - low, 0)
+        starts = np.arange(sizes.sum()) + np.repeat(low - (np.cumsum(sizes) - sizes), sizes)
+
+        # Equal windows are grouped as fixed-size byte strings, so only distinct ones become bytes objects
+        rows = np.ascontiguousarray(sliding_window_view(values, length)[starts])
+        unique_rows, counts = np.unique(rows.view(np.dtype((np.void, length))).ravel(), return_counts=True)
+        raw = unique_rows.tobytes()
+        windows.update(dict(zip((raw[i:i + length] for i in range(0, len(raw), length)), counts.tolist())))
+    return windows
+
+def update_subsequence_counts(subsequence_counts, removed_windows, added_windows):
+    """Apply one replacement to the counts instead of recounting the whole data.
+
+    Windows away from the replaced spans keep their bytes, so only the ones overlapping them change.
+    Sequences dropping to one occurrence are forgotten, and new ones seen once among the added windows
+    are left out, so counts of sequences that were unique before can lag behind.
+    """
+    for window, count in removed_windows.items():
+        if window in subsequence_counts:
+            subsequence_counts[window] -= count
+            if subsequence_counts[window] <= 1:
+                del subsequence_counts[window]
+    for window, count in added_windows.items():
+        if window in subsequence_counts:
+            subsequence_counts[window] += count
+        elif count > 1:
+            subsequence_counts[window] = count
 
-    present_sequences = set().union(*present_sequence_chunks)
-    all_possible_sequences = {bytes((i >> (8 * j)) & 0xFF for j in range(sequence_length)) for i in range(256 ** sequence_length)}
-    return sorted(all_possible_sequences - present_sequences)
+def find_missing_sequences_chunk(data, sequence_length, start, end):
+    """Bitmap of the big-endian keys of the windows starting in [start, end), read past end if needed."""
+    present = bytearray(256 ** sequence_length)
+    mask = len(present) - 1
+    stop = min(end, len(data) - sequence_length + 1)
+    key = 0
+    for i, byte in enumerate(data[start:stop + sequence_length - 1]):
+        key = ((key << 8) | byte) & mask
+        if i >= sequence_length - 1:
+            present[key] = 1
+    return present
+
+def find_missing_sequences_shared(data_length, sequence_length, start, end):
+    return find_missing_sequences_chunk(shared_data.buf[:data_length], sequence_length, start, end)
+
+if njit is not None:
+    @njit(parallel=True, boundscheck=False, cache=True)
+    def mark_present_sequences(values, sequence_length, present):
+        # Every thread only ever stores True, so overlapping writes need no atomics
+        for i in prange(len(values) - sequence_length + 1):
+            key = 0
+            for j in range(sequence_length):
+                key = (key << 8) | values[i + j]
+            present[key] = True
+else:
+    mark_present_sequences = None
+
+def find_missing_sequences(data, pool, shared, sequence_length):
+    """Return the sequences of sequence_length absent from data, largest first so they can be popped from the tail."""
+    if np is not None:
+        # Big-endian keys keep the bitmap in the sorted order of the byte sequences
+        values = np.frombuffer(data, dtype=np.uint8)
+        if sequence_length == 1:
+            present = np.bincount(values, minlength=256) > 0
+        elif sequence_length == 2:
+            pairs = (values[:-1].astype(np.uint16) << 8) | values[1:]
+            present = np.bincount(pairs, minlength=65536) > 0
+        else:
+            present = np.zeros(256 ** sequence_length, dtype=np.bool_)
+            if mark_present_sequences is not None:
+                mark_present_sequences(values, sequence_length, present)
+            elif len(values) >= sequence_length:
+                present[window_hashes(values, sequence_length).astype(np.int64)] = True
+        missing = np.flatnonzero(~present)[::-1]
+        raw = ((missing[:, None] >> (8 * np.arange(sequence_length - 1, -1, -1))) & 0xFF).astype(np.uint8).tobytes()
+        return [raw[i:i + sequence_length] for i in range(0, len(raw), sequence_length)]
+
+    # Absent bytes take one pass in C and absent pairs fit a 64KB bitmap, neither is worth the workers
+    if sequence_length == 1:
+        return [bytes([byte]) for byte in sorted(set(range(256)).difference(data), reverse=True)]
+    if sequence_length == 2:
+        present = find_missing_sequences_chunk(data, sequence_length, 0, len(data))
+    else:
+        data_length = len(data)
+        shared.buf[:data_length] = data
+        chunk_size = (data_length + NUM_WORKERS - 1) // NUM_WORKERS
+        tasks = [(data_length, sequence_length, i * chunk_size, min((i + 1) * chunk_size, data_length)) for i in range(NUM_WORKERS)]
+        present_sequence_chunks = pool.starmap(find_missing_sequences_shared, tasks)
+
+        # Flags are 0 or 1 per byte, so OR-ing the bitmaps as big integers merges them
+        present = 0
+        for chunk in present_sequence_chunks:
+            present |= int.from_bytes(chunk, 'big')
+        present = present.to_bytes(256 ** sequence_length, 'big')
+
+    missing_sequences = []
+    key = present.rfind(0)
+    while key != -1:
+        missing_sequences.append(key.to_bytes(sequence_length, 'big'))
+        key = present.rfind(0, 0, key)
+    return missing_sequences
 
 def read_file(file_path):
     try:
         with open(file_path, 'rb') as f:
-            return f.read()
+            data = bytearray(os.fstat(f.fileno()).st_size)
+            f.readinto(data)
+            return data
     except IOError as e:
         print(f"Error reading file {file_path}: {e}")
         sys.exit(1)
@@ -78,96 +461,181 @@ def write_file(file_path, data):
         print(f"Error writing file {file_path}: {e}")
         sys.exit(1)
 
-def write_boo_file(boo_file_path, dictionaries, data, original_extension):
+def pwrite_all(fd, buffers, offset):
+    """Write buffers back to back at offset, one pwritev call unless the kernel writes short."""
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    if not hasattr(os, 'pwritev'):
+        # Windows has no positional writes, so seek once and write the buffers in turn
+        os.lseek(fd, offset, os.SEEK_SET)
+        for view in views:
+            while view:
+                view = view[os.write(fd, view):]
+        return
+    while views:
+        written = os.pwritev(fd, views, offset)
+        offset += written
+        while views and written >= len(views[0]):
+            written -= len(views.pop(0))
+        if written:
+            views[0] = views[0][written:]
+
+def pack_boo_entries(missing_seqs, substituted_seqs):
+    entries = bytearray()
+    for missing_seq, substituted_seq in zip(missing_seqs, substituted_seqs):
+        entries.append(len(missing_seq))
+        entries.append(len(substituted_seq))
+        entries += missing_seq
+        entries += substituted_seq
+    return entries
+
+def create_boo_file(boo_file_path, missing_seqs, substituted_seqs, original_extension, data):
+    """Write a complete boo file beside the target and move it into place, so an existing one is never lost.
+
+    Returns the open descriptor and where the dictionary ends.
+    """
+    temp_path = boo_file_path + '.tmp'
+    # Without O_BINARY, Windows would translate newlines in everything written through the descriptor
+    flags = os.O_RDWR | getattr(os, 'O_BINARY', 0)
     try:
-        with open(boo_file_path, 'wb') as boo_file:
-            boo_file.write(bytes([len(original_extension)]))
-            boo_file.write(original_extension.encode())
-
-            for dictionary in dictionaries:
-                for missing_seq, substituted_seq in dictionary.items():
-                    boo_file.write(bytes([len(missing_seq)]))
-                    boo_file.write(bytes([len(substituted_seq)]))
-                    boo_file.write(missing_seq)
-                    boo_file.write(substituted_seq)
-            boo_file.write(bytes([0, 255]))
-            boo_file.write(data)
-
-        return os.path.getsize(boo_file_path)
-    except IOError as e:
+        boo_fd = os.open(temp_path, flags | os.O_CREAT | os.O_TRUNC, 0o644)
+        header = bytes([len(original_extension)]) + original_extension.encode()
+        entries = pack_boo_entries(missing_seqs, substituted_seqs)
+        pwrite_all(boo_fd, [header, entries, bytes([0, 255]), data], 0)
+        os.fsync(boo_fd)
+        # Windows can't rename an open file, so the descriptor is reopened once the file is in place
+        os.close(boo_fd)
+        os.replace(temp_path, boo_file_path)
+        return os.open(boo_file_path, flags), len(header) + len(entries)
+    except OSError as e:
         print(f"Error writing to boo file {boo_file_path}: {e}")
         sys.exit(1)
 
+def checkpoint_boo_file(boo_fd, missing_seqs, substituted_seqs, dictionary_end, data):
+    """Append the given new dictionary entries and rewrite the data behind them, leaving the rest of the file alone."""
+    try:
+        entries = pack_boo_entries(missing_seqs, substituted_seqs)
+        pwrite_all(boo_fd, [entries, bytes([0, 255]), data], dictionary_end)
+        dictionary_end += len(entries)
+        os.ftruncate(boo_fd, dictionary_end + 2 + len(data))
+        return dictionary_end
+    except OSError as e:
+        print(f"Error writing to boo file: {e}")
+        sys.exit(1)
+
 def load_dictionaries_and_data(boo_file_path):
-    dictionaries = []
-    with open(boo_file_path, 'rb') as f:
-        extension_length = f.read(1)[0]
-        original_extension = f.read(extension_length).decode() if extension_length > 0 else ""
-        while True:
-            missing_len_byte = f.read(1)
-            if not missing_len_byte:
-                break
-            missing_len = missing_len_byte[0]
-            substituted_len = f.read(1)[0]
+    """Parse the boo file by indexing a read-only mapping of it, copying out only the entries and the data."""
+    missing_seqs = []
+    substituted_seqs = []
+    with open(boo_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+        extension_length = view[0]
+        original_extension = bytes(view[1:1 + extension_length]).decode()
+        cursor = 1 + extension_length
+        while cursor < len(view):
+            missing_len = view[cursor]
+            substituted_len = view[cursor + 1]
+            cursor += 2
             if missing_len == 0 and substituted_len == 255:
-                data = f.read()
+                data = bytearray(view[cursor:])
                 break
-            missing_seq = f.read(missing_len)
-            substituted_seq = f.read(substituted_len)
-            dictionaries.append({missing_seq: substituted_seq})
-    return dictionaries, data, original_extension
+            missing_seqs.append(bytes(view[cursor:cursor + missing_len]))
+            cursor += missing_len
+            substituted_seqs.append(bytes(view[cursor:cursor + substituted_len]))
+            cursor += substituted_len
+    return missing_seqs, substituted_seqs, data, original_extension
 
 def add_or_replace_extension(file_path):
     return os.path.splitext(file_path)[0] + '.boo'
 
 def main(file_path, total_iterations, max_length, top_n=256):
-    start_time = datetime.now()
+    start_ns = perf_counter_ns()
     boo_file_path = add_or_replace_extension(file_path)
 
     if file_path.endswith('.boo'):
         boo_file_path = file_path
-        dictionaries, data, original_extension = load_dictionaries_and_data(file_path)
-        iteration_count = len(dictionaries)
+        missing_seqs, substituted_seqs, data, original_extension = load_dictionaries_and_data(file_path)
+        iteration_count = len(missing_seqs)
     else:
         data = read_file(file_path)
-        dictionaries = []
+        missing_seqs = []
+        substituted_seqs = []
         original_extension = os.path.splitext(file_path)[1]
         iteration_count = 0
 
     original_size = os.path.getsize(file_path)
     sequence_length = 1
 
-    while sequence_length <= max_length and (total_iterations == -1 or iteration_count < total_iterations):
-        now_time = datetime.now()
-        timing = time_difference(now_time, start_time)
-        print(f"{timing} Processing sequence length: {sequence_length}")
-        missing_sequences = find_missing_sequences(data, sequence_length)
-        if not missing_sequences:
-            sequence_length += 1
-            continue
-
-        while missing_sequences and (total_iterations == -1 or iteration_count < total_iterations):
-            subsequence_counts = extract_and_filter_subsequences(data, sequence_length, max_length)
-            most_common_subsequences = find_most_common_subsequences(subsequence_counts, sequence_length, top_n)
-            if not most_common_subsequences:
-                break
-
-            highest_score_sequence, (score, occurrences) = most_common_subsequences[0]
-            first_missing_sequence = missing_sequences.pop(0)
-
-            data = data.replace(bytes(highest_score_sequence), bytes(first_missing_sequence))
-            dictionaries.append({first_missing_sequence: highest_score_sequence})
-            iteration_count += 1
-
-            now_time = datetime.now()
-            timing = time_difference(now_time, start_time)
-
-            new_size = write_boo_file(boo_file_path, dictionaries, data, original_extension)
-            ratio = f"{(new_size / original_size) * 100:.3f}%"
-
-            print(f"{timing} Iteration {iteration_count} for sequence length {sequence_length} completed. Size {new_size}b Ratio {ratio}")
+    # The file starts out complete, and every pass appends its entries behind the ones on disk and rewrites the data
+    boo_fd, dictionary_end = create_boo_file(boo_file_path, missing_seqs, substituted_seqs, original_extension, data)
+    written_count = len(missing_seqs)
+    in_pass = False
+    dictionary_size = dictionary_end + 2  # Header, entries and termination bytes
+
+    # One Pool serves every fallback call; data only shrinks, so the shared block is sized once
+    pool = shared = None
+    if np is None:
+        shared = SharedMemory(create=True, size=max(len(data), 1))
+        pool = Pool(processes=NUM_WORKERS, initializer=attach_shared_data, initargs=(shared.name,))
+    try:
+        while sequence_length <= max_length and (total_iterations == -1 or iteration_count < total_iterations):
+            print(f"{time_difference(perf_counter_ns(), start_ns)} Processing sequence length: {sequence_length}")
+            missing_sequences = find_missing_sequences(data, pool, shared, sequence_length)
+            if not missing_sequences:
+                sequence_length += 1
+                continue
+
+            subsequence_counts = extract_and_filter_subsequences(data, pool, shared, sequence_length, max_length)
+            while missing_sequences and (total_iterations == -1 or iteration_count < total_iterations):
+                most_common_subsequences = find_most_common_subsequences(subsequence_counts, sequence_length, top_n)
+                if not most_common_subsequences:
+                    break
+
+                # Top candidates that can't interfere with each other are all substituted in one rebuild
+                limit = -1 if total_iterations == -1 else total_iterations - iteration_count
+                substitutions = select_substitutions(data, most_common_subsequences, missing_sequences, limit)
+                if not substitutions:
+                    break
+
+                # Only the windows around the replaced spans change, so the counts are patched rather than rebuilt,
+                # unless the suffix array recounts faster or the spans cover much of the data.
+                # The data is rewritten in place, so it only matches the entries again once they are all added.
+                removed_spans = substituted_spans(substitutions)
+                recount = divsufsort is not None or touches_most_windows(removed_spans, max_length, len(data))
+                in_pass = True
+                if not recount:
+                    removed_windows = collect_windows(data, removed_spans, sequence_length, max_length)
+                added_spans = apply_substitutions(data, substitutions)
+                if recount:
+                    subsequence_counts = extract_and_filter_subsequences(data, pool, shared, sequence_length, max_length)
+                else:
+                    added_windows = collect_windows(data, added_spans, sequence_length, max_length)
+                    update_subsequence_counts(subsequence_counts, removed_windows, added_windows)
+                for highest_score_sequence, first_missing_sequence, _ in substitutions:
+                    missing_seqs.append(first_missing_sequence)
+                    substituted_seqs.append(highest_score_sequence)
+                    dictionary_size += 2 + len(first_missing_sequence) + len(highest_score_sequence)
+                iteration_count += len(substitutions)
+                in_pass = False
+
+                dictionary_end = checkpoint_boo_file(boo_fd, missing_seqs[written_count:], substituted_seqs[written_count:], dictionary_end, data)
+                written_count = len(missing_seqs)
+
+                # One timestamp and one formatted line per iteration
+                timing = time_difference(perf_counter_ns(), start_ns)
+                new_size = dictionary_size + len(data)
+                print(f"{timing} Iteration {iteration_count} for sequence length {sequence_length} completed. Size {new_size}b Ratio {new_size / original_size * 100:.3f}%")
 
-        sequence_length += 1
+            sequence_length += 1
+    finally:
+        # Entries added by a finished pass whose checkpoint was cut short are still written; a pass cut short
+        # itself left the data half rewritten, so the file keeps the state of the pass before it
+        if written_count < len(missing_seqs) and not in_pass:
+            checkpoint_boo_file(boo_fd, missing_seqs[written_count:], substituted_seqs[written_count:], dictionary_end, data)
+        os.close(boo_fd)
+        if pool is not None:
+            pool.close()
+            pool.join()
+            shared.close()
+            shared.unlink()
 
 if __name__ == "__main__":
     if len(sys.argv) < 4:
@@ -1,68 +1,302 @@
 import sys
-from datetime import datetime
+import os
+import io
+import mmap
+from time import perf_counter_ns
+from queue import Queue
+from threading import Thread
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# The last round is written out in chunks of about this many bytes instead of being joined first
+STREAM_CHUNK_SIZE = 1 << 22
+
+# The compiled scanner splits a round into up to this many chunks of at least MIN_CHUNK_SIZE bytes
+NUM_CHUNKS = os.cpu_count() or 1
+MIN_CHUNK_SIZE = 1 << 16
+
+# Chunks produced but not yet written are capped at this many
+WRITE_QUEUE_SIZE = 4
+
+# Progress lines are printed at most this often
+PROGRESS_INTERVAL_NS = 100_000_000
 
 # Global start time
-start_time = datetime.now()
-
-def get_timestamp():
-    """Get the time difference from the start_time."""
-    now = datetime.now()
-    diff = abs(now - start_time)
-    total_seconds = int(diff.total_seconds())
-    milliseconds = int((diff.total_seconds() - total_seconds) * 1000)
-    hours, remainder = divmod(total_seconds, 3600)
-    minutes, seconds = divmod(remainder, 60)
+start_ns = perf_counter_ns()
+
+def get_timestamp(now_ns=None):
+    """Get the time difference from start_ns."""
+    milliseconds = ((perf_counter_ns() if now_ns is None else now_ns) - start_ns) // 1_000_000
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
     return f"[{hours:02}:{minutes:02}:{seconds:02}.{milliseconds:03}]" if hours <= 99 else "[99:59:59.999]+"
 
-def write_file(file_path, data):
+def drain_chunks(f, chunks, errors):
+    # Keeps taking chunks after a failed write, so the producer never blocks on a full queue
+    while (chunk := chunks.get()) is not None:
+        if not errors:
+            try:
+                f.write(chunk)
+            except OSError as e:
+                errors.append(e)
+
+def write_file(file_path, chunks):
+    """Write the chunks from a second thread, so the disk is busy while the next chunk is produced."""
     with open(file_path, 'wb') as f:
-        f.write(data)
+        pending = Queue(maxsize=WRITE_QUEUE_SIZE)
+        errors = []
+        writer = Thread(target=drain_chunks, args=(f, pending, errors))
+        writer.start()
+        try:
+            for chunk in chunks:
+                pending.put(chunk)
+        finally:
+            pending.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
 
 def load_dictionaries_and_data(boo_file_path):
+    """Parse the boo file by indexing a read-only mapping of it; the data is returned as a view of the mapping."""
     with open(boo_file_path, 'rb') as f:
-        dictionaries = []
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    missing_seqs = []
+    substituted_seqs = []
+
+    # Read the original extension length and extension
+    extension_length = view[0]
+    original_extension = bytes(view[1:1 + extension_length]).decode()
+    cursor = 1 + extension_length
+
+    while cursor < len(view):
+        missing_len = view[cursor]
+        substituted_len = view[cursor + 1]
+        cursor += 2
+        if missing_len == 0 and substituted_len == 255:
+            break  # Separator found
+        missing_seqs.append(bytes(view[cursor:cursor + missing_len]))
+        cursor += missing_len
+        substituted_seqs.append(bytes(view[cursor:cursor + substituted_len]))
+        cursor += substituted_len
+    return missing_seqs, substituted_seqs, view[cursor:], original_extension
+
+def straddles(key, value):
+    """Check whether key can overlap an inserted copy of value without lying inside it, whatever surrounds it."""
+    for offset in range(1 - len(key), len(value)):
+        if offset >= 0 and offset + len(key) <= len(value):
+            continue
+        low, high = max(offset, 0), min(offset + len(key), len(value))
+        if key[low - offset:high - offset] == value[low:high]:
+            return True
+    return False
 
-        # Read the original extension length and extension
-        extension_length = f.read(1)[0]
-        if extension_length > 0:
-            original_extension = f.read(extension_length).decode()
+def substitution_rounds(missing_seqs, substituted_seqs):
+    """Split the dictionaries, in the order they are undone, into rounds that one pass can replace together.
+
+    A round ends before an entry whose missing sequence shares a byte with a key already in it, since their
+    occurrences could then overlap. When it only shares bytes with values of the round, it is an entry of a
+    chain: if it can't form across the edges of those values, it is replaced inside them right away and its
+    own occurrences join the round, otherwise the round ends. Empty keys match everywhere and empty values
+    join their neighbours, so those close their round.
+    """
+    rounds = []
+    key_bytes = set()
+    value_bytes = set()
+    for missing_seq, substituted_seq in zip(reversed(missing_seqs), reversed(substituted_seqs)):
+        missing_bytes = set(missing_seq)
+        chained = rounds and missing_seq and not value_bytes.isdisjoint(missing_bytes)
+        if not rounds or not missing_seq or not key_bytes.isdisjoint(missing_bytes) or (chained and any(
+                straddles(missing_seq, value) for _, value in rounds[-1] if not missing_bytes.isdisjoint(value))):
+            rounds.append([])
+            key_bytes = set()
+            value_bytes = set()
+        elif chained:
+            rounds[-1] = [(key, value.replace(missing_seq, substituted_seq)) for key, value in rounds[-1]]
+        rounds[-1].append((missing_seq, substituted_seq))
+        key_bytes.update(missing_bytes if missing_seq and substituted_seq else range(256))
+        value_bytes.update(substituted_seq)
+    return rounds
+
+def round_pieces(text, substitutions):
+    """Yield the text with every key of a round replaced, in one left to right Aho-Corasick pass over it."""
+    automaton = ahocorasick.Automaton()
+    for missing_seq, substituted_seq in substitutions:
+        automaton.add_word(missing_seq, (len(missing_seq), substituted_seq))
+    automaton.make_automaton()
+
+    # Keys of a round share no byte, so at most one starts at any position and the leftmost longest matches
+    # iter_long reports are exactly the non-overlapping ones str.replace would take
+    read = 0
+    for end, (length, substituted_seq) in automaton.iter_long(text):
+        yield text[read:end - length + 1]
+        yield substituted_seq
+        read = end + 1
+    yield text[read:]
+
+if njit is not None:
+    @njit(cache=True)
+    def key_at(data, position, key_bytes, start, end):
+        if position + end - start > len(data):
+            return False
+        for j in range(end - start):
+            if data[position + j] != key_bytes[start + j]:
+                return False
+        return True
+
+    @njit(cache=True)
+    def replace_chunk(data, start, end, out, written, first_key, key_bytes, key_offsets, value_bytes, value_offsets):
+        # Keys of a round share no byte, so the first byte tells the only key that can start at a position.
+        # With an empty out the chunk is only measured.
+        i = start
+        while i < end:
+            key = first_key[data[i]]
+            if key >= 0 and key_at(data, i, key_bytes, key_offsets[key], key_offsets[key + 1]):
+                if len(out):
+                    out[written:written + value_offsets[key + 1] - value_offsets[key]] = value_bytes[value_offsets[key]:value_offsets[key + 1]]
+                written += value_offsets[key + 1] - value_offsets[key]
+                i += key_offsets[key + 1] - key_offsets[key]
+            else:
+                if len(out):
+                    out[written] = data[i]
+                written += 1
+                i += 1
+        return written
+
+    @njit(parallel=True, cache=True)
+    def replace_round_kernel(data, chunks, first_key, key_bytes, key_offsets, value_bytes, value_offsets):
+        # A chunk may only start right after a byte no key contains, since no match can run across that byte
+        # and the scan from there goes exactly as it would from the start of the data
+        is_key_byte = np.zeros(256, dtype=np.bool_)
+        for byte in key_bytes:
+            is_key_byte[byte] = True
+        bounds = np.empty(chunks + 1, dtype=np.int64)
+        bounds[0] = 0
+        for chunk in range(1, chunks):
+            position = max(len(data) * chunk // chunks, bounds[chunk - 1])
+            while 0 < position < len(data) and is_key_byte[data[position - 1]]:
+                position += 1
+            bounds[chunk] = position
+        bounds[chunks] = len(data)
+
+        # The first pass sizes the output of every chunk and the second fills it in place
+        sizes = np.zeros(chunks, dtype=np.int64)
+        for chunk in prange(chunks):
+            sizes[chunk] = replace_chunk(data, bounds[chunk], bounds[chunk + 1], np.empty(0, dtype=np.uint8), 0,
+                                         first_key, key_bytes, key_offsets, value_bytes, value_offsets)
+        offsets = np.zeros(chunks + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)
+        out = np.empty(offsets[chunks], dtype=np.uint8)
+        for chunk in prange(chunks):
+            replace_chunk(data, bounds[chunk], bounds[chunk + 1], out, offsets[chunk],
+                          first_key, key_bytes, key_offsets, value_bytes, value_offsets)
+        return out
+
+def replace_round_compiled(data, substitutions):
+    """Replace every key of a round in one left to right pass of the compiled scanner, split across cores."""
+    first_key = np.full(256, -1, dtype=np.int64)
+    for key, (missing_seq, _) in enumerate(substitutions):
+        first_key[missing_seq[0]] = key
+    key_bytes = np.frombuffer(b''.join(m for m, _ in substitutions), dtype=np.uint8)
+    key_offsets = np.cumsum([0] + [len(m) for m, _ in substitutions], dtype=np.int64)
+    value_bytes = np.frombuffer(b''.join(s for _, s in substitutions), dtype=np.uint8)
+    value_offsets = np.cumsum([0] + [len(s) for _, s in substitutions], dtype=np.int64)
+    values = np.frombuffer(data, dtype=np.uint8)
+    chunks = max(min(NUM_CHUNKS, len(values) // MIN_CHUNK_SIZE), 1)
+    return replace_round_kernel(values, chunks, first_key, key_bytes, key_offsets, value_bytes, value_offsets).tobytes()
+
+def output_chunks(pieces, is_text):
+    """Group the pieces of the output into bytes chunks of about STREAM_CHUNK_SIZE, cutting long pieces up."""
+    pending = []
+    size = 0
+    for piece in pieces:
+        start = 0
+        while size + len(piece) - start >= STREAM_CHUNK_SIZE:
+            end = start + STREAM_CHUNK_SIZE - size
+            pending.append(piece[start:end])
+            yield ''.join(pending).encode('latin-1') if is_text else b''.join(pending)
+            pending = []
+            size = 0
+            start = end
+        if start < len(piece):
+            pending.append(piece[start:])
+            size += len(piece) - start
+    if pending:
+        yield ''.join(pending).encode('latin-1') if is_text else b''.join(pending)
+
+def decompress(data, missing_seqs, substituted_seqs):
+    """Undo the dictionaries and yield the original data in chunks, streaming the last round as it is replaced."""
+    if ahocorasick is None and njit is None:
+        # Values in a round may already have later entries replaced inside them, so without a single pass
+        # replacer every entry is undone on its own
+        rounds = [[entry] for entry in zip(reversed(missing_seqs), reversed(substituted_seqs))]
+    else:
+        rounds = substitution_rounds(missing_seqs, substituted_seqs)
+    # The compiled scanner is preferred, it needs no Python call per match and splits the rounds across cores
+    is_text = njit is None and ahocorasick is not None
+    if is_text:
+        # The automaton works on str and latin-1 maps every byte to the code point of the same value, so the
+        # payload is decoded once, straight from the mapped file, and every round works on the same text
+        data = str(data, 'latin-1')
+    else:
+        data = bytes(data)
+
+    pieces = [data]
+    i = 0
+    last_print_ns = 0
+    for round_number, substitutions in enumerate(rounds, 1):
+        i += len(substitutions)
+        now_ns = perf_counter_ns()
+        if now_ns - last_print_ns >= PROGRESS_INTERVAL_NS or round_number == len(rounds):
+            last_print_ns = now_ns
+            sys.stdout.write(f"\r{get_timestamp(now_ns)} Processing dictionary {i}/{len(missing_seqs)}...")
+            sys.stdout.flush()
+        if len(substitutions) > 1 and all(len(m) == len(s) == 1 for m, s in substitutions):
+            # A round of single bytes to single bytes is one table lookup per byte, which bytes.translate does in C
+            table = bytes.maketrans(b''.join(m for m, _ in substitutions), b''.join(s for _, s in substitutions))
+            data = data.encode('latin-1').translate(table).decode('latin-1') if is_text else data.translate(table)
+            pieces = [data]
+        elif len(substitutions) > 1 and is_text:
+            pieces = round_pieces(data, [(m.decode('latin-1'), s.decode('latin-1')) for m, s in substitutions])
+            # Only the rounds before the last are gathered, for the next one to scan. Writing into one growing
+            # buffer keeps just the output in memory, where a join would hold every piece until the end.
+            if round_number < len(rounds):
+                buffer = io.StringIO()
+                buffer.writelines(pieces)
+                data = buffer.getvalue()
+        elif len(substitutions) > 1:
+            data = replace_round_compiled(data, substitutions)
+            pieces = [data]
         else:
-            original_extension = ""
-
-        while True:
-            missing_len_byte = f.read(1)
-            if not missing_len_byte:
-                break  # End of file
-            missing_len = missing_len_byte[0]
-            substituted_len = f.read(1)[0]
-            if missing_len == 0 and substituted_len == 255:
-                break  # Separator found
-            missing_seq = f.read(missing_len)
-            substituted_seq = f.read(substituted_len)
-            dictionaries.append((missing_seq, substituted_seq))
-        data = f.read()
-    return dictionaries, data, original_extension
-
-def decompress(data, dictionaries):
-    i = 1
-    for missing_seq, substituted_seq in reversed(dictionaries):        
-        print(f"\r{get_timestamp()} Processing dictionary {i}/{len(dictionaries)}...", end="", flush=True)
-        data = data.replace(missing_seq, substituted_seq)
-        i = i + 1
-    return data
+            missing_seq, substituted_seq = substitutions[0]
+            if is_text:
+                missing_seq, substituted_seq = missing_seq.decode('latin-1'), substituted_seq.decode('latin-1')
+            data = data.replace(missing_seq, substituted_seq)
+            pieces = [data]
+    yield from output_chunks(pieces, is_text)
 
 def main(file_path):
     # Read the .boo file
     print(f"{get_timestamp()} Beginning decompression...")
-    dictionaries, compressed_data, original_extension = load_dictionaries_and_data(file_path)
-
-    # Decompress the data
-    decompressed_data = decompress(compressed_data, dictionaries)
+    missing_seqs, substituted_seqs, compressed_data, original_extension = load_dictionaries_and_data(file_path)
 
-    # Save the decompressed file
+    # Decompress the data straight into the decompressed file
     decompressed_file_path = file_path.replace('.boo', original_extension)
     decompressed_file_path = 'deco_' + decompressed_file_path
-    write_file(decompressed_file_path, decompressed_data)
+    write_file(decompressed_file_path, decompress(compressed_data, missing_seqs, substituted_seqs))
     print(f"{get_timestamp()} Decompression completed successfully!!!")
 
 if __name__ == "__main__":